@@ -5,57 +5,400 @@ Analyzes character count, word count, and estimated token count for markdown fil
 """
 
 import os
-import glob
+import argparse
+import mmap
 import re
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from rich.console import Console
 from rich.table import Table
 from rich.panel import Panel
 from rich import print as rprint
 
+try:
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # Optional; the NumPy scanner is used instead
+    NUMBA_AVAILABLE = False
+
 console = Console()
 
+# Precompiled patterns shared by every file analyzed
+_CODE_BLOCK_RE = re.compile(r'```[\s\S]*?```')
+
+# Byte classes for the vectorized scanner; whitespace is what str.split()
+# splits on: the ASCII bytes here, plus the multi-byte characters below
+_WHITESPACE_BYTES = np.zeros(256, dtype=bool)
+_WHITESPACE_BYTES[list(b' \t\n\v\f\r\x1c\x1d\x1e\x1f')] = True
+_WHITESPACE_INDEX = np.flatnonzero(_WHITESPACE_BYTES)
+
+# Non-ASCII whitespace in UTF-8: U+0085 and U+00A0 are C2 85 and C2 A0;
+# U+2000-U+200A, U+2028, U+2029 and U+202F are E2 80 xx (xx marked here);
+# U+205F, U+1680 and U+3000 are E2 81 9F, E1 9A 80 and E3 80 80
+_E2_80_SPACE = np.zeros(256, dtype=bool)
+_E2_80_SPACE[list(range(0x80, 0x8B)) + [0xA8, 0xA9, 0xAF]] = True
+
+# Line boundaries as str.splitlines() sees them: the ASCII separators here,
+# plus the multi-byte U+0085, U+2028 and U+2029 below
+_LINE_BREAK_BYTES = np.zeros(256, dtype=bool)
+_LINE_BREAK_BYTES[list(b'\n\v\f\r\x1c\x1d\x1e')] = True
+_LINE_BREAK_INDEX = np.flatnonzero(_LINE_BREAK_BYTES)
+_UNICODE_LINE_BREAKS = (b'\xc2\x85', b'\xe2\x80\xa8', b'\xe2\x80\xa9')
+
+_TOKENS_PER_CHAR = 1 / 3.2
+
+# Files are scanned in chunks of this many bytes
+CHUNK_SIZE = 1 << 20
+
+# Directories with fewer files than this are analyzed in-process
+PARALLEL_MIN_FILES = 8
+
 def estimate_tokens(text):
     """
     Estimate token count using a simple approximation.
     GPT-style tokenizers typically use ~4 characters per token for English text.
     For code and technical content, it's often closer to 3-3.5 characters per token.
     """
-    # Remove extra whitespace and normalize
-    cleaned_text = re.sub(r'\s+', ' ', text.strip())
+    state = new_scan_state()
+    data = text.encode('utf-8')
+    if data:
+        scan_chunk(np.frombuffer(data, dtype=np.uint8), state)
+    
+    return estimate_tokens_from_scan(state)
+
+def estimate_tokens_from_scan(state):
+    """Estimate token count from scan_chunk() counters."""
+    # Stripping the text and collapsing each whitespace run to one space
+    # leaves the non-whitespace characters plus one space per run between
+    # words, so the cleaned length needs no cleaned copy of the text
+    whitespace_runs = max(state['words'] - 1, 0)
+    cleaned_length = state['characters'] - state['whitespace'] + whitespace_runs
     
     # For technical/code content, use 3.2 chars per token as estimate
-    estimated_tokens = len(cleaned_text) / 3.2
+    estimated_tokens = cleaned_length * _TOKENS_PER_CHAR
     
     return int(estimated_tokens)
 
 def count_code_blocks(text):
     """Count the number of code blocks in the markdown."""
-    code_block_pattern = r'```[\s\S]*?```'
-    return len(re.findall(code_block_pattern, text))
+    # Iterate match objects instead of building a list of matched substrings
+    count = 0
+    for _ in _CODE_BLOCK_RE.finditer(text):
+        count += 1
+    return count
+
+def new_scan_state():
+    """Return the running counters accumulated by scan_chunk()."""
+    return {
+        'bytes': 0,
+        'characters': 0,       # UTF-8 characters (non-continuation bytes)
+        'stripped': 0,         # Spaces, tabs, \n and \r
+        'whitespace': 0,       # Whitespace characters, as str.split() sees them
+        'line_breaks': 0,      # Every separator str.splitlines() splits on
+        'crlf': 0,             # \r\n pairs, which text mode reads as one \n
+        'words': 0,
+        'fences': 0,
+        'backtick_run': 0,     # Backticks at the end of the previous chunk
+        'prev_whitespace': True,
+        'prev_cr': False,
+        'tail': b'',           # Last three bytes seen, to tell if the text ends a line
+    }
+
+def _unicode_whitespace(buf):
+    """
+    Find non-ASCII whitespace characters in a uint8 array.
+    Returns a mask over every byte of those characters, how many there are,
+    and how many of them (U+0085, U+2028, U+2029) are line separators.
+    """
+    mask = np.zeros(buf.size, dtype=bool)
+    
+    first, second = buf[:-1], buf[1:]
+    two_byte = (first == 0xC2) & ((second == 0x85) | (second == 0xA0))
+    count = int(np.count_nonzero(two_byte))
+    line_breaks = int(np.count_nonzero(two_byte & (second == 0x85)))
+    mask[:-1] |= two_byte
+    mask[1:] |= two_byte
+    
+    if buf.size >= 3:
+        b0, b1, b2 = buf[:-2], buf[1:-1], buf[2:]
+        e2_80 = (b0 == 0xE2) & (b1 == 0x80)
+        three_byte = (
+            (e2_80 & _E2_80_SPACE[b2])
+            | ((b0 == 0xE2) & (b1 == 0x81) & (b2 == 0x9F))
+            | ((b0 == 0xE1) & (b1 == 0x9A) & (b2 == 0x80))
+            | ((b0 == 0xE3) & (b1 == 0x80) & (b2 == 0x80))
+        )
+        count += int(np.count_nonzero(three_byte))
+        line_breaks += int(np.count_nonzero(e2_80 & ((b2 == 0xA8) | (b2 == 0xA9))))
+        mask[:-2] |= three_byte
+        mask[1:-1] |= three_byte
+        mask[2:] |= three_byte
+    
+    return mask, count, line_breaks
+
+def _ends_with_line_break(tail):
+    """Return whether the bytes seen so far end with a line separator."""
+    if not tail:
+        return False
+    return bool(_LINE_BREAK_BYTES[tail[-1]]) or tail.endswith(_UNICODE_LINE_BREAKS)
+
+def _scan_chunk_numpy(buf, state):
+    """
+    Accumulate character-class counts for one chunk of UTF-8 bytes.
+    Chunks must not split a UTF-8 character.
+    """
+    # One C-level pass gives every per-class count we need
+    histogram = np.bincount(buf, minlength=256)
+    whitespace_count = int(histogram[_WHITESPACE_INDEX].sum())
+    
+    state['bytes'] += buf.size
+    state['characters'] += buf.size - int(histogram[0x80:0xC0].sum())
+    state['stripped'] += int(histogram[0x20] + histogram[0x09] + histogram[0x0A] + histogram[0x0D])
+    state['whitespace'] += whitespace_count
+    state['line_breaks'] += int(histogram[_LINE_BREAK_INDEX].sum())
+    
+    # Multi-byte whitespace can only start with one of these lead bytes
+    unicode_space = None
+    if buf.size >= 2 and (histogram[0xC2] or histogram[0xE1] or histogram[0xE2] or histogram[0xE3]):
+        unicode_space, unicode_count, unicode_breaks = _unicode_whitespace(buf)
+        state['whitespace'] += unicode_count
+        state['line_breaks'] += unicode_breaks
+    
+    if histogram[0x0D]:
+        cr = buf == 0x0D
+        state['crlf'] += int(np.count_nonzero(cr[:-1] & (buf[1:] == 0x0A)))
+    if state['prev_cr'] and buf[0] == 0x0A:
+        state['crlf'] += 1
+    
+    # A word starts at every non-whitespace byte that follows whitespace
+    last_is_space = bool(_WHITESPACE_BYTES[buf[-1]])
+    if unicode_space is not None or 0 < whitespace_count < buf.size:
+        is_space = _WHITESPACE_BYTES[buf]
+        if unicode_space is not None:
+            is_space |= unicode_space
+        word_start = ~is_space
+        word_start[1:] &= is_space[:-1]
+        word_start[0] &= state['prev_whitespace']
+        state['words'] += int(np.count_nonzero(word_start))
+        last_is_space = bool(is_space[-1])
+    elif whitespace_count == 0:
+        state['words'] += int(state['prev_whitespace'])
+    
+    # Every three consecutive backticks form one fence; a code block is a
+    # pair of fences, matching count_code_blocks()
+    if state['backtick_run'] and buf[0] != 0x60:
+        state['fences'] += state['backtick_run'] // 3
+        state['backtick_run'] = 0
+    if histogram[0x60]:
+        edges = np.diff((buf == 0x60).view(np.int8), prepend=0, append=0)
+        starts = np.flatnonzero(edges == 1)
+        ends = np.flatnonzero(edges == -1)
+        runs = ends - starts
+        if starts[0] == 0:
+            runs[0] += state['backtick_run']
+            state['backtick_run'] = 0
+        if ends[-1] == buf.size:
+            state['backtick_run'] = int(runs[-1])
+            runs = runs[:-1]
+        state['fences'] += int((runs // 3).sum())
+    
+    state['prev_whitespace'] = last_is_space
+    state['prev_cr'] = bool(buf[-1] == 0x0D)
+    state['tail'] = (state['tail'] + bytes(buf[-3:]))[-3:]
+
+def _scan_bytes(buf, is_whitespace, is_line_break, prev_whitespace, prev_cr, backtick_run):
+    """
+    Count character classes in a single pass over a uint8 array.
+    The array must not split a UTF-8 character.
+    """
+    characters = 0
+    stripped = 0
+    whitespace = 0
+    line_breaks = 0
+    crlf = 0
+    words = 0
+    fences = 0
+    space_bytes_left = 0  # Continuation bytes of a multi-byte whitespace character
+    size = buf.size
+    
+    for i in range(size):
+        b = buf[i]
+        if (b & 0xC0) != 0x80:
+            characters += 1
+        
+        # Multi-byte whitespace: C2 85 / C2 A0, E2 80 xx for U+2000-U+200A,
+        # U+2028, U+2029 and U+202F, E2 81 9F, E1 9A 80 and E3 80 80
+        space_length = 0
+        if b >= 0xC2 and b <= 0xE3 and i + 1 < size:
+            b1 = buf[i + 1]
+            if b == 0xC2:
+                if b1 == 0x85 or b1 == 0xA0:
+                    space_length = 2
+                    if b1 == 0x85:
+                        line_breaks += 1
+            elif i + 2 < size:
+                b2 = buf[i + 2]
+                if b == 0xE2 and b1 == 0x80:
+                    if b2 <= 0x8A or b2 == 0xA8 or b2 == 0xA9 or b2 == 0xAF:
+                        space_length = 3
+                        if b2 == 0xA8 or b2 == 0xA9:
+                            line_breaks += 1
+                elif ((b == 0xE2 and b1 == 0x81 and b2 == 0x9F)
+                      or (b == 0xE1 and b1 == 0x9A and b2 == 0x80)
+                      or (b == 0xE3 and b1 == 0x80 and b2 == 0x80)):
+                    space_length = 3
+        
+        if space_length:
+            whitespace += 1
+            space_bytes_left = space_length - 1
+            prev_whitespace = True
+        elif space_bytes_left:
+            space_bytes_left -= 1
+        elif is_whitespace[b]:
+            whitespace += 1
+            if is_line_break[b]:
+                line_breaks += 1
+            if b == 0x20 or b == 0x09 or b == 0x0A or b == 0x0D:
+                stripped += 1
+            if b == 0x0A and prev_cr:
+                crlf += 1
+            prev_whitespace = True
+        else:
+            if prev_whitespace:
+                words += 1
+            prev_whitespace = False
+        
+        if b == 0x60:
+            backtick_run += 1
+        elif backtick_run:
+            fences += backtick_run // 3
+            backtick_run = 0
+        
+        prev_cr = b == 0x0D
+    
+    return (characters, stripped, whitespace, line_breaks, crlf, words,
+            fences, backtick_run, prev_whitespace, prev_cr)
+
+def _scan_chunk_numba(buf, state):
+    """Accumulate character-class counts for one chunk using the JIT scanner."""
+    (characters, stripped, whitespace, line_breaks, crlf, words,
+     fences, backtick_run, prev_whitespace, prev_cr) = _scan_bytes_jit(
+        buf, _WHITESPACE_BYTES, _LINE_BREAK_BYTES, state['prev_whitespace'],
+        state['prev_cr'], state['backtick_run'])
+    
+    state['bytes'] += buf.size
+    state['characters'] += characters
+    state['stripped'] += stripped
+    state['whitespace'] += whitespace
+    state['line_breaks'] += line_breaks
+    state['crlf'] += crlf
+    state['words'] += words
+    state['fences'] += fences
+    state['backtick_run'] = backtick_run
+    state['prev_whitespace'] = prev_whitespace
+    state['prev_cr'] = prev_cr
+    state['tail'] = (state['tail'] + bytes(buf[-3:]))[-3:]
+
+# Numba compiles the byte loop to machine code; without it the vectorized
+# NumPy scanner is the faster choice
+if NUMBA_AVAILABLE:
+    _scan_bytes_jit = njit(cache=True)(_scan_bytes)
+    scan_chunk = _scan_chunk_numba
+else:
+    scan_chunk = _scan_chunk_numpy
 
-def analyze_file(file_path):
-    """Analyze a single markdown file."""
+def _chunk_end(buf, start):
+    """Return where the chunk starting at start ends, without splitting a UTF-8 character."""
+    end = min(start + CHUNK_SIZE, buf.size)
+    # Back up over at most three continuation bytes to the character start
+    for _ in range(3):
+        if end == start or end == buf.size or (buf[end] & 0xC0) != 0x80:
+            break
+        end -= 1
+    if end == start:
+        # The chunk is smaller than one character; take the whole character
+        end = min(start + 1, buf.size)
+        while end < buf.size and (buf[end] & 0xC0) == 0x80:
+            end += 1
+    return end
+
+def analyze_file(file_path, filename=None, file_size=None):
+    """
+    Analyze a single markdown file, scanning it in fixed-size chunks.
+    Returns (stats, error) without touching the console, so it can run in
+    worker processes. filename and file_size may be passed in when the
+    caller already has them from a directory listing. Lines are counted as
+    str.splitlines() would count them on the text-mode contents.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
+        state = new_scan_state()
+        if filename is None:
+            filename = os.path.basename(file_path)
+        
+        # Scan the file through a read-only memory map, so the page cache
+        # backs the arrays directly instead of copying into bytes objects
+        with open(file_path, 'rb') as f:
+            if file_size is None:
+                file_size = os.fstat(f.fileno()).st_size
+            scan_error = None
+            if file_size:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    buf = np.frombuffer(mm, dtype=np.uint8)
+                    try:
+                        start = 0
+                        while start < buf.size:
+                            end = _chunk_end(buf, start)
+                            scan_chunk(buf[start:end], state)
+                            start = end
+                    except BaseException as e:
+                        # The traceback's frames still hold views of the map;
+                        # drop them so the map can close, then re-raise below
+                        scan_error = e.with_traceback(None)
+                    # The map cannot close while an array still exports it
+                    del buf
+            if scan_error is not None:
+                raise scan_error
+        
+        # Report counts as text mode would read the file: universal newlines
+        # turn \r\n into a single \n and a lone \r into \n
+        characters = state['characters'] - state['crlf']
+        stripped = state['stripped'] - state['crlf']
+        line_breaks = state['line_breaks'] - state['crlf']
+        fences = state['fences'] + state['backtick_run'] // 3
+        has_partial_line = bool(state['tail']) and not _ends_with_line_break(state['tail'])
         
         stats = {
-            'filename': os.path.basename(file_path),
-            'file_size_kb': round(os.path.getsize(file_path) / 1024, 2),
-            'characters': len(content),
-            'characters_no_spaces': len(content.replace(' ', '').replace('\n', '').replace('\t', '')),
-            'words': len(content.split()),
-            'lines': len(content.splitlines()),
-            'code_blocks': count_code_blocks(content),
-            'estimated_tokens': estimate_tokens(content)
+            'filename': filename,
+            'file_size_kb': round(state['bytes'] / 1024, 2),
+            'characters': characters,
+            'characters_no_spaces': characters - stripped,
+            'words': state['words'],
+            'lines': line_breaks + int(has_partial_line),
+            'code_blocks': fences // 2,
+            'estimated_tokens': estimate_tokens_from_scan(state)
         }
         
-        return stats, content
+        return stats, None
     
     except Exception as e:
-        console.print(f"[red]Error analyzing {file_path}: {e}[/red]")
-        return None, None
+        return None, f"Error analyzing {file_path}: {e}"
+
+def analyze_files(entries):
+    """Analyze os.DirEntry files in parallel worker processes, preserving input order."""
+    # DirEntry objects cannot be pickled, so pass along what the listing
+    # already knows: the path, the name and the cached stat size
+    paths = [entry.path for entry in entries]
+    names = [entry.name for entry in entries]
+    sizes = [entry.stat().st_size for entry in entries]
+    
+    # Starting workers costs more than it saves for a handful of files
+    if len(entries) < PARALLEL_MIN_FILES:
+        return list(map(analyze_file, paths, names, sizes))
+    
+    max_workers = min(os.cpu_count() or 1, len(entries))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(analyze_file, paths, names, sizes, chunksize=8))
 
 def get_model_context_limits():
     """Return context limits for popular models."""
@@ -69,9 +412,14 @@ def get_model_context_limits():
         'codellama:13b': 16384,
     }
 
-def analyze_directory(directory):
+def analyze_directory(directory, summary_only=False):
     """Analyze all markdown files in a directory."""
-    files = glob.glob(os.path.join(directory, "*.md"))
+    # One directory read gives names, types and cached stat results
+    with os.scandir(directory) as it:
+        files = [
+            entry for entry in it
+            if entry.name.endswith('.md') and not entry.name.startswith('.') and entry.is_file()
+        ]
     
     if not files:
         console.print(f"[yellow]No .md files found in {directory}/[/yellow]")
@@ -83,17 +431,6 @@ def analyze_directory(directory):
         border_style="blue"
     ))
     
-    # Create results table
-    table = Table(title=f"File Analysis Results")
-    table.add_column("File", style="cyan", no_wrap=True)
-    table.add_column("Size (KB)", justify="right", style="magenta")
-    table.add_column("Characters", justify="right", style="green")
-    table.add_column("Words", justify="right", style="yellow")
-    table.add_column("Lines", justify="right", style="blue")
-    table.add_column("Code Blocks", justify="right", style="red")
-    table.add_column("Est. Tokens", justify="right", style="bold green")
-    table.add_column("Model Fit", justify="center", style="white")
-    
     total_stats = {
         'files': 0,
         'total_size': 0,
@@ -104,27 +441,40 @@ def analyze_directory(directory):
         'total_tokens': 0
     }
     
-    model_limits = get_model_context_limits()
+    # A file's fit is decided by the largest context available, so the
+    # thresholds are computed once instead of scanning every model per file
+    largest_context = max(get_model_context_limits().values())
+    comfortable_tokens = largest_context * 0.7  # Use 70% of context for safety
+    tight_tokens = largest_context * 0.9  # 90% is risky but possible
+    rows = []
     
     # Analyze each file
-    for file_path in files:
-        stats, content = analyze_file(file_path)
+    for stats, error in analyze_files(files):
         if stats is None:
+            console.print(f"[red]{error}[/red]")
+            continue
+        
+        # Update totals
+        total_stats['files'] += 1
+        total_stats['total_size'] += stats['file_size_kb']
+        total_stats['total_chars'] += stats['characters']
+        total_stats['total_words'] += stats['words']
+        total_stats['total_lines'] += stats['lines']
+        total_stats['total_code_blocks'] += stats['code_blocks']
+        total_stats['total_tokens'] += stats['estimated_tokens']
+        
+        if summary_only:
             continue
         
-        # Determine which models can handle this file
-        model_fit = []
-        for model, limit in model_limits.items():
-            if stats['estimated_tokens'] <= limit * 0.7:  # Use 70% of context for safety
-                model_fit.append("✅")
-                break
-            elif stats['estimated_tokens'] <= limit * 0.9:  # 90% is risky but possible
-                model_fit.append("⚠️")
-                break
+        # Determine whether any model can handle this file
+        if stats['estimated_tokens'] <= comfortable_tokens:
+            model_fit = "✅"
+        elif stats['estimated_tokens'] <= tight_tokens:
+            model_fit = "⚠️"
         else:
-            model_fit.append("❌")  # Too large for most models
+            model_fit = "❌"  # Too large for every model
         
-        table.add_row(
+        rows.append((
             stats['filename'][:20] + ("..." if len(stats['filename']) > 20 else ""),
             str(stats['file_size_kb']),
             f"{stats['characters']:,}",
@@ -132,19 +482,26 @@ def analyze_directory(directory):
             str(stats['lines']),
             str(stats['code_blocks']),
             f"{stats['estimated_tokens']:,}",
-            "".join(model_fit)
-        )
-        
-        # Update totals
-        total_stats['files'] += 1
-        total_stats['total_size'] += stats['file_size_kb']
-        total_stats['total_chars'] += stats['characters']
-        total_stats['total_words'] += stats['words']
-        total_stats['total_lines'] += stats['lines']
-        total_stats['total_code_blocks'] += stats['code_blocks']
-        total_stats['total_tokens'] += stats['estimated_tokens']
+            model_fit
+        ))
     
-    console.print(table)
+    # Build the results table once all rows are known, then render it once
+    if not summary_only:
+        # Create results table
+        table = Table(title=f"File Analysis Results")
+        table.add_column("File", style="cyan", no_wrap=True)
+        table.add_column("Size (KB)", justify="right", style="magenta")
+        table.add_column("Characters", justify="right", style="green")
+        table.add_column("Words", justify="right", style="yellow")
+        table.add_column("Lines", justify="right", style="blue")
+        table.add_column("Code Blocks", justify="right", style="red")
+        table.add_column("Est. Tokens", justify="right", style="bold green")
+        table.add_column("Model Fit", justify="center", style="white")
+        
+        for row in rows:
+            table.add_row(*row)
+        
+        console.print(table)
     
     # Show totals
     totals_table = Table(title="Summary Statistics")
@@ -187,9 +544,14 @@ def main():
         border_style="blue"
     ))
     
+    parser = argparse.ArgumentParser(description="Analyze context size of markdown files")
+    parser.add_argument("--summary-only", action="store_true",
+                        help="only print the summary tables, not one row per file")
+    args = parser.parse_args()
+    
     # Analyze input directory
     if os.path.exists("input"):
-        analyze_directory("input")
+        analyze_directory("input", summary_only=args.summary_only)
     else:
         console.print("[red]Input directory not found![/red]")
     
@@ -198,7 +560,7 @@ def main():
     # Also analyze outputs if they exist
     if os.path.exists("outputs"):
         console.print(Panel("[yellow]Output Directory Analysis[/yellow]", border_style="yellow"))
-        analyze_directory("outputs")
+        analyze_directory("outputs", summary_only=args.summary_only)
 
 if __name__ == "__main__":
     main()
@@ -5,8 +5,14 @@ Reads .md files from input/, processes them with Gemini API, and saves structure
 """
 
 import os
+import argparse
+import asyncio
 import glob
+import functools
+import hashlib
 import json
+import re
+import threading
 import time
 from pathlib import Path
 from rich.console import Console
@@ -16,12 +22,33 @@ from rich.table import Table
 from rich import print as rprint
 import google.generativeai as genai
 from dotenv import load_dotenv
+from analyze_context import estimate_tokens
 
 # Load environment variables
 load_dotenv()
 
 console = Console()
 
+MODEL_NAME = "models/gemini-2.5-pro"
+
+# Formatted responses are cached here, keyed by a hash of the request
+CACHE_DIR = "cache"
+
+# Maximum number of Gemini requests in flight at once; keep within your QPS quota
+MAX_CONCURRENT_REQUESTS = 8
+
+# Gemini 2.5 Pro output limit, shared with the generation config
+MAX_OUTPUT_TOKENS = 100000
+
+# Small files are sent together so they share one copy of the template.
+# The formatted output restates all of its input, so a batch has to fit
+# comfortably in the output limit rather than the (much larger) context.
+MAX_BATCH_FILES = 8
+BATCH_TOKEN_BUDGET = int(MAX_OUTPUT_TOKENS * 0.8)
+
+# Gemini 2.5 Pro input context window
+MODEL_CONTEXT_TOKENS = 1_000_000
+
 # RAG-Optimized Template for Library Components
 TEMPLATE_PROMPT = """
 You are a technical documentation formatter specializing in creating RAG-optimized content for library components.
@@ -95,6 +122,28 @@ Original content to format:
 {content}
 """
 
+# Variant of the template for several documents in one request
+TEMPLATE_PROMPT_BATCH = TEMPLATE_PROMPT.replace("""Original content to format:
+
+{content}""", """The content below contains several separate documents. Each one starts with a
+<<<FILE:name>>> marker line. Format every document independently using the structure
+above, and emit each formatted result between a <<<OUT:name>>> line and a <<<ENDOUT>>>
+line, using the same name as its input marker. Do not write anything outside these markers.
+
+Documents to format:
+
+{content}""")
+
+_BATCH_OUTPUT_RE = re.compile(r'<<<OUT:(.+?)>>>\n?(.*?)<<<ENDOUT>>>', re.DOTALL)
+
+# Files estimated above this are split at headings before calling the API:
+# the input has to fit the context next to the template and the response,
+# and the response restates the input, so it also has to fit the output limit
+FILE_TOKEN_BUDGET = int(min(
+    MODEL_CONTEXT_TOKENS - MAX_OUTPUT_TOKENS - estimate_tokens(TEMPLATE_PROMPT),
+    MAX_OUTPUT_TOKENS,
+) * 0.9)
+
 def setup_gemini():
     """Setup Gemini API client."""
     api_key = os.getenv('GEMINI_API_KEY')
@@ -108,14 +157,17 @@ def setup_gemini():
         ))
         return None
     
-    genai.configure(api_key=api_key)
+    # All requests go through generate_content_async, so use the asyncio gRPC
+    # transport: the SDK keeps one client (and one multiplexed HTTP/2 channel)
+    # for the whole run instead of reconnecting per request
+    genai.configure(api_key=api_key, transport="grpc_asyncio")
     
     # Configure the model
     generation_config = {
         "temperature": 0.1,  # Low temperature for consistent formatting
         "top_p": 0.95,
         "top_k": 64,
-        "max_output_tokens": 100000,  # Gemini 2.5 Pro maximum limit (100K tokens)
+        "max_output_tokens": MAX_OUTPUT_TOKENS,  # Gemini 2.5 Pro maximum limit (100K tokens)
     }
     
     safety_settings = [
@@ -126,37 +178,56 @@ def setup_gemini():
     ]
     
     model = genai.GenerativeModel(
-        model_name="models/gemini-2.5-pro",  # Gemini 2.5 Pro with larger context
+        model_name=MODEL_NAME,  # Gemini 2.5 Pro with larger context
         generation_config=generation_config,
         safety_settings=safety_settings
     )
     
     return model
 
-def load_markdown(file_path):
-    """Load markdown content from a file."""
+def _read_text(file_path):
+    with open(file_path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+async def load_markdown(file_path):
+    """Load markdown content from a file without blocking the event loop."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        return content
+        return await asyncio.to_thread(_read_text, file_path)
     except Exception as e:
         console.print(f"[red]Error reading {file_path}: {e}[/red]")
         return None
 
-def process_with_gemini(text, template, model):
-    """Process text with Gemini API."""
+def looks_truncated(input_length, response_text):
+    """Return whether a response is significantly smaller than its input."""
+    return len(response_text) < input_length * 0.8
+
+@functools.lru_cache(maxsize=None)
+def split_template(template):
+    """Split a prompt template around its {content} placeholder into prefix and suffix."""
+    prefix, suffix = template.split("{content}")
+    return (
+        prefix.replace("{{", "{").replace("}}", "}"),
+        suffix.replace("{{", "{").replace("}}", "}"),
+    )
+
+async def process_with_gemini(text, template, model):
+    """Process text (a string or a list of string parts) with Gemini API."""
     try:
-        # Prepare the prompt
-        full_prompt = template.format(content=text)
+        # Prepare the prompt as separate parts so the content is never copied
+        # into one large prompt string
+        prefix, suffix = split_template(template)
+        content_parts = text if isinstance(text, list) else [text]
+        prompt_parts = [part for part in (prefix, *content_parts, suffix) if part]
+        input_length = sum(map(len, content_parts))
         
         # Call Gemini API
-        response = model.generate_content(full_prompt)
+        response = await model.generate_content_async(prompt_parts)
         
         if response.text:
             # Check if response was truncated
             response_text = response.text.strip()
-            if len(response_text) < len(text) * 0.8:  # If output is significantly smaller
-                console.print(f"[yellow]Warning: Response may be truncated (input: {len(text)} chars, output: {len(response_text)} chars)[/yellow]")
+            if looks_truncated(input_length, response_text):
+                console.print(f"[yellow]Warning: Response may be truncated (input: {input_length} chars, output: {len(response_text)} chars)[/yellow]")
             return response_text
         else:
             console.print(f"[red]Gemini returned empty response[/red]")
@@ -168,20 +239,278 @@ def process_with_gemini(text, template, model):
         console.print(f"[red]Error calling Gemini API: {e}[/red]")
         return None
 
-def save_output(content, output_path):
-    """Save processed content to output file."""
+def _write_atomic(content, path):
+    """Write text via a temporary file and os.replace, so a failed write never leaves a partial file."""
+    # Encode once and hand the bytes to a single buffered binary write
+    data = content.encode('utf-8')
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
     try:
-        # Ensure output directory exists
-        os.makedirs(os.path.dirname(output_path), exist_ok=True)
-        
-        with open(output_path, 'w', encoding='utf-8') as f:
-            f.write(content)
+        with open(tmp_path, 'wb', buffering=1 << 20) as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+async def save_output(content, output_path):
+    """Save processed content to output file without blocking the event loop."""
+    try:
+        # The output directory is created once by process_markdown_files
+        await asyncio.to_thread(_write_atomic, content, output_path)
         return True
     except Exception as e:
         console.print(f"[red]Error saving {output_path}: {e}[/red]")
         return False
 
-def process_markdown_files():
+def cache_key(content, template=TEMPLATE_PROMPT, model_name=MODEL_NAME):
+    """Hash the template, model and input content into a cache key."""
+    digest = hashlib.sha256(template.encode('utf-8'))
+    digest.update(b'|' + model_name.encode('utf-8') + b'|')
+    digest.update(content.encode('utf-8'))
+    return digest.hexdigest()
+
+async def load_cached(key):
+    """Return the cached response for a key, or None on a miss."""
+    cache_path = os.path.join(CACHE_DIR, f"{key}.md")
+    if not os.path.exists(cache_path):
+        return None
+    return await load_markdown(cache_path)
+
+async def store_cached(key, content):
+    """Write a response to the cache atomically."""
+    try:
+        # CACHE_DIR is created once by process_markdown_files
+        await asyncio.to_thread(_write_atomic, content, os.path.join(CACHE_DIR, f"{key}.md"))
+    except Exception as e:
+        console.print(f"[yellow]Warning: could not cache response: {e}[/yellow]")
+
+def plan_batches(documents):
+    """Group (filename, content) pairs into batches that fit BATCH_TOKEN_BUDGET."""
+    batches = []
+    batch = []
+    batch_tokens = 0
+    
+    for filename, content in documents:
+        tokens = estimate_tokens(content)
+        if batch and (batch_tokens + tokens > BATCH_TOKEN_BUDGET or len(batch) >= MAX_BATCH_FILES):
+            batches.append(batch)
+            batch = []
+            batch_tokens = 0
+        batch.append((filename, content))
+        batch_tokens += tokens
+    
+    if batch:
+        batches.append(batch)
+    return batches
+
+def split_markdown(content, token_budget):
+    """Split markdown at top-level (# / ##) headings into parts within token_budget."""
+    # Cut before every heading that is not inside a code block
+    sections = []
+    section_lines = []
+    in_code_block = False
+    for line in content.splitlines(keepends=True):
+        if line.startswith('```'):
+            in_code_block = not in_code_block
+        elif not in_code_block and (line.startswith('# ') or line.startswith('## ')) and section_lines:
+            sections.append(''.join(section_lines))
+            section_lines = []
+        section_lines.append(line)
+    if section_lines:
+        sections.append(''.join(section_lines))
+    
+    # Pack neighbouring sections back together up to the budget; a single
+    # section larger than the budget is sent on its own
+    parts = []
+    part = ''
+    part_tokens = 0
+    for section in sections:
+        tokens = estimate_tokens(section)
+        if part and part_tokens + tokens > token_budget:
+            parts.append(part)
+            part = ''
+            part_tokens = 0
+        part += section
+        part_tokens += tokens
+    if part:
+        parts.append(part)
+    
+    return parts
+
+def build_batch_content(batch):
+    """Return prompt parts for a batch, each document under a <<<FILE:name>>> marker."""
+    parts = []
+    for filename, content in batch:
+        marker = f"<<<FILE:{filename}>>>\n"
+        parts.append(f"\n\n{marker}" if parts else marker)
+        parts.append(content)
+    return parts
+
+def split_batch_response(response_text):
+    """Map each filename to its formatted output from a batched response."""
+    # Empty sections count as missing, like an empty single-file response
+    outputs = {}
+    for name, body in _BATCH_OUTPUT_RE.findall(response_text):
+        body = body.strip()
+        if body:
+            outputs[name.strip()] = body
+    return outputs
+
+async def process_batch(batch, output_dir, model, semaphore, progress):
+    """Format and save a batch of documents. Returns the elapsed time, or None on failure, per file."""
+    label = batch[0][0] if len(batch) == 1 else f"{len(batch)} files"
+    
+    async with semaphore:
+        task = progress.add_task(f"Processing {label}...", total=None)
+        batch_start_time = time.time()
+        
+        try:
+            if len(batch) == 1:
+                filename, content = batch[0]
+                outputs = {filename: await process_with_gemini(content, TEMPLATE_PROMPT, model)}
+            else:
+                response_text = await process_with_gemini(build_batch_content(batch), TEMPLATE_PROMPT_BATCH, model)
+                outputs = split_batch_response(response_text) if response_text else {}
+        finally:
+            progress.remove_task(task)
+        
+        file_time = (time.time() - batch_start_time) / len(batch)
+    
+    # Documents the model dropped from a batched response get their own
+    # request; retries and saves run concurrently under the shared semaphore
+    results = [None] * len(batch)
+    jobs = []
+    job_indexes = []
+    for index, (filename, content) in enumerate(batch):
+        formatted_content = outputs.get(filename)
+        if not formatted_content and len(batch) > 1:
+            console.print(f"[yellow]{filename} missing from batched response, retrying alone[/yellow]")
+            jobs.append(process_alone(filename, content, output_dir, model, semaphore, progress))
+        elif formatted_content:
+            jobs.append(finish_document(filename, content, formatted_content, output_dir, file_time))
+        else:
+            continue
+        job_indexes.append(index)
+    
+    for index, file_time in zip(job_indexes, await asyncio.gather(*jobs)):
+        results[index] = file_time
+    
+    return results
+
+async def process_alone(filename, content, output_dir, model, semaphore, progress):
+    """Format and save one document in its own request. Returns the elapsed time, or None on failure."""
+    results = await process_batch([(filename, content)], output_dir, model, semaphore, progress)
+    return results[0]
+
+async def format_section(section, label, model, semaphore, progress):
+    """Format one section of an oversized document."""
+    async with semaphore:
+        task = progress.add_task(f"Processing {label}...", total=None)
+        try:
+            return await process_with_gemini(section, TEMPLATE_PROMPT, model)
+        finally:
+            progress.remove_task(task)
+
+async def process_sections(filename, content, sections, output_dir, model, semaphore, progress):
+    """Format an oversized document section by section and save the joined result."""
+    start_time = time.time()
+    formatted_sections = await asyncio.gather(*(
+        format_section(section, f"{filename} part {i}/{len(sections)}", model, semaphore, progress)
+        for i, section in enumerate(sections, 1)
+    ))
+    
+    if any(section is None for section in formatted_sections):
+        console.print(f"[red]❌ Failed to process {filename}: a section could not be formatted[/red]")
+        return [None]
+    
+    formatted_content = "\n\n".join(formatted_sections)
+    return [await finish_document(filename, content, formatted_content, output_dir, time.time() - start_time)]
+
+async def finish_document(filename, content, formatted_content, output_dir, file_time):
+    """Cache and save a formatted document. Returns the elapsed time, or None on failure."""
+    # A possibly truncated response is still saved, but not cached, so that
+    # rerunning the pipeline asks the API again
+    if looks_truncated(len(content), formatted_content):
+        console.print(f"[yellow]Not caching {filename}: response may be truncated[/yellow]")
+    else:
+        await store_cached(cache_key(content), formatted_content)
+    
+    # Save output with same filename
+    output_path = os.path.join(output_dir, filename)
+    if not await save_output(formatted_content, output_path):
+        return None
+    
+    console.print(f"[green]✅ Processed: {filename} ({file_time:.2f}s)[/green]")
+    return file_time
+
+async def process_files(batches, large_documents, output_dir, model, progress):
+    """Process all batches and split documents with at most MAX_CONCURRENT_REQUESTS API calls in flight."""
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    batch_results = await asyncio.gather(
+        *(process_batch(batch, output_dir, model, semaphore, progress) for batch in batches),
+        *(process_sections(filename, content, sections, output_dir, model, semaphore, progress)
+          for filename, content, sections in large_documents),
+    )
+    return [file_time for results in batch_results for file_time in results]
+
+async def run_pipeline(files, output_dir, model, use_cache):
+    """Load, plan and format all files. Returns per-file times and the cache hit count."""
+    # Load every file up front so small ones can be batched by size
+    contents = await asyncio.gather(*(load_markdown(file_path) for file_path in files))
+    documents = [
+        (os.path.basename(file_path), raw_content)
+        for file_path, raw_content in zip(files, contents)
+        if raw_content is not None
+    ]
+    
+    # Serve repeated inputs from the cache; the rest go to the API
+    cached = 0
+    if use_cache:
+        cached_contents = await asyncio.gather(*(
+            load_cached(cache_key(raw_content)) for _, raw_content in documents
+        ))
+        hits = [i for i, cached_content in enumerate(cached_contents) if cached_content is not None]
+        saved = await asyncio.gather(*(
+            save_output(cached_contents[i], os.path.join(output_dir, documents[i][0])) for i in hits
+        ))
+        written = {i for i, ok in zip(hits, saved) if ok}
+        pending = []
+        for i, (filename, raw_content) in enumerate(documents):
+            if i in written:
+                console.print(f"[green]✅ From cache: {filename}[/green]")
+                cached += 1
+            else:
+                pending.append((filename, raw_content))
+        documents = pending
+    
+    # Files too large for a single request are split at headings up front,
+    # instead of sending them and finding out from a truncated response
+    small_documents = []
+    large_documents = []
+    for filename, raw_content in documents:
+        if estimate_tokens(raw_content) > FILE_TOKEN_BUDGET:
+            sections = split_markdown(raw_content, FILE_TOKEN_BUDGET)
+            if len(sections) > 1:
+                console.print(f"[yellow]{filename} exceeds the request budget, splitting into {len(sections)} parts[/yellow]")
+                large_documents.append((filename, raw_content, sections))
+                continue
+            console.print(f"[yellow]Warning: {filename} exceeds the request budget but has no headings to split at[/yellow]")
+        small_documents.append((filename, raw_content))
+    
+    batches = plan_batches(small_documents)
+    
+    # Process batches concurrently; each file reports its elapsed time or None
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[progress.description]{task.description}"),
+        console=console
+    ) as progress:
+        file_times = await process_files(batches, large_documents, output_dir, model, progress)
+    
+    return file_times, cached
+
+def process_markdown_files(use_cache=True):
     """Main processing function."""
     start_time = time.time()
     
@@ -196,6 +525,7 @@ def process_markdown_files():
     
     os.makedirs(input_dir, exist_ok=True)
     os.makedirs(output_dir, exist_ok=True)
+    os.makedirs(CACHE_DIR, exist_ok=True)
     
     # Find all markdown files
     files = glob.glob(os.path.join(input_dir, "*.md"))
@@ -214,52 +544,12 @@ def process_markdown_files():
         border_style="green"
     ))
     
-    # Statistics
-    processed = 0
-    failed = 0
-    processing_times = []
+    file_times, cached = asyncio.run(run_pipeline(files, output_dir, model, use_cache))
     
-    # Process each file
-    with Progress(
-        SpinnerColumn(),
-        TextColumn("[progress.description]{task.description}"),
-        console=console
-    ) as progress:
-        
-        for file_path in files:
-            filename = os.path.basename(file_path)
-            task = progress.add_task(f"Processing {filename}...", total=None)
-            file_start_time = time.time()
-            
-            try:
-                # Load markdown content
-                raw_content = load_markdown(file_path)
-                if raw_content is None:
-                    failed += 1
-                    continue
-                
-                # Process with Gemini
-                formatted_content = process_with_gemini(raw_content, TEMPLATE_PROMPT, model)
-                if formatted_content is None:
-                    failed += 1
-                    continue
-                
-                # Save output with same filename
-                input_filename = os.path.basename(file_path)
-                output_path = os.path.join("outputs", input_filename)
-                if save_output(formatted_content, output_path):
-                    file_time = time.time() - file_start_time
-                    processing_times.append(file_time)
-                    processed += 1
-                    console.print(f"[green]✅ Processed: {filename} ({file_time:.2f}s)[/green]")
-                else:
-                    failed += 1
-                    
-            except Exception as e:
-                console.print(f"[red]❌ Failed to process {filename}: {e}[/red]")
-                failed += 1
-            
-            progress.remove_task(task)
+    # Statistics
+    processing_times = [t for t in file_times if t is not None]
+    processed = len(processing_times) + cached
+    failed = len(files) - processed
     
     total_time = time.time() - start_time
     avg_time = sum(processing_times) / len(processing_times) if processing_times else 0
@@ -271,6 +561,7 @@ def process_markdown_files():
     table.add_column("Time", justify="right", style="yellow")
     
     table.add_row("✅ Successfully Processed", str(processed), f"{avg_time:.2f}s avg")
+    table.add_row("💾 From Cache", str(cached), "-")
     table.add_row("❌ Failed", str(failed), "-")
     table.add_row("📁 Total Files", str(len(files)), f"{total_time:.2f}s total")
     
@@ -290,12 +581,17 @@ def main():
     """Main entry point."""
     console.print(Panel(
         "[bold blue]Markdown Processing Pipeline with Gemini 2.5 Pro[/bold blue]\n"
-        "Model: models/gemini-2.5-pro",
+        f"Model: {MODEL_NAME}",
         title="📝 Markdown Formatter",
         border_style="blue"
     ))
     
-    process_markdown_files()
+    parser = argparse.ArgumentParser(description="Format markdown files with Gemini")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="ignore cached responses and call the API for every file")
+    args = parser.parse_args()
+    
+    process_markdown_files(use_cache=not args.no_cache)
 
 if __name__ == "__main__":
     main()